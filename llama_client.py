@@ -1,11 +1,199 @@
-import requests
-import json
-from llama_initializer import get_server_status
+import asyncio
+import httpx
+from types import MappingProxyType
+from llama_initializer import get_server_status, server_url, chat_format, api_token, hf_model_file_name, n_parallel
 
+try:
+    import orjson
+    _json_dumps = orjson.dumps
+    _json_loads = orjson.loads
+except ImportError:  # Fall back to the stdlib json module when orjson is unavailable
+    import json
 
-def send_completion_request(prompt, max_tokens=500, temperature=0.7):
+    def _json_dumps(obj):
+        return json.dumps(obj).encode("utf-8")
+
+    _json_loads = json.loads
+
+# Shared async client so concurrent jobs keep several requests in flight against the
+# server (letting it batch them) while reusing pooled keep-alive connections
+_CLIENT = httpx.AsyncClient(
+    timeout=120,
+    limits=httpx.Limits(max_connections=64, max_keepalive_connections=64)
+)
+
+# Prompt prefix, suffix and stop sequences for chat formats rendered client-side, so
+# single-message requests can use /v1/completions and skip server-side templating
+_CHAT_TEMPLATES = {
+    "gemma": ("<start_of_turn>user\n", "<end_of_turn>\n<start_of_turn>model\n", ["<end_of_turn>"]),
+    "chatml": ("<|im_start|>user\n", "<|im_end|>\n<|im_start|>assistant\n", ["<|im_end|>"]),
+    "llama-3": (
+        "<|start_header_id|>user<|end_header_id|>\n\n",
+        "<|eot_id|><|start_header_id|>assistant<|end_header_id|>\n\n",
+        ["<|eot_id|>"]
+    ),
+    "llama-2": ("[INST] ", " [/INST]", []),
+}
+# Formats not listed above fall back to /v1/chat/completions
+_TEMPLATE = _CHAT_TEMPLATES.get(chat_format)
+
+# Request pieces that never change, built once at import instead of per request
+_URL = f"{server_url}/v1/completions" if _TEMPLATE else f"{server_url}/v1/chat/completions"
+_MODEL = hf_model_file_name
+_STATUS = get_server_status()
+# Authorization is only bound when API_TOKEN is set, so requests never branch on it
+_HEADERS = MappingProxyType(
+    {"Content-Type": "application/json", **({"Authorization": f"Bearer {api_token}"} if api_token else {})}
+)
+
+# Maximum number of bytes of an unexpected server response echoed back in the error
+_MAX_ERROR_BODY = 2048
+
+# Non-streaming requests arriving within this window are coalesced into one multi-prompt request
+_BATCH_WINDOW = 0.01
+# A multi-prompt request only returns once every prompt in it is done, so batches larger than the
+# server's parallel slots would make the first jobs wait for later ones to be decoded
+_MAX_BATCH_SIZE = min(16, n_parallel)
+_batch_queue = asyncio.Queue()
+_batch_worker_task = None
+_batch_tasks = set()  # Keep references so in-flight batch requests are not garbage collected
+
+
+def _build_payload(prompt, max_tokens, temperature, stream=False):
+    """Return the payload for a single user message."""
+    # Prepare request payload for llama-server (OpenAI compatible completions)
+    if _TEMPLATE:
+        prefix, suffix, stop = _TEMPLATE
+        payload = {
+            "prompt": f"{prefix}{prompt}{suffix}",
+            "stop": stop,
+            "model": _MODEL,
+            "max_tokens": max_tokens,
+            "temperature": temperature
+        }
+    else:
+        payload = {
+            "messages": [{"role": "user", "content": prompt}],
+            "model": _MODEL,
+            "max_tokens": max_tokens,
+            "temperature": temperature
+        }
+    if stream:
+        payload["stream"] = True
+    return payload
+
+
+def _coerce_params(max_tokens, temperature):
+    """Coerce sampling parameters from job input, raising ValueError when they are not numbers."""
+    try:
+        return int(max_tokens), float(temperature)
+    except (TypeError, ValueError):
+        raise ValueError("'max_tokens' must be an integer and 'temperature' a number.")
+
+
+def _unexpected_response(result):
+    """Error response for a malformed server reply, keeping only the start of the serialized body."""
+    # Cut on bytes and drop a trailing partial UTF-8 sequence, if any
+    body = _json_dumps(result)[:_MAX_ERROR_BODY].decode("utf-8", errors="ignore")
+    return {"error": f"Unexpected response format from LLM server: {body}"}
+
+
+def _http_error(e):
+    """Turn an httpx error into an error response, with the server's error body when available."""
+    print(f"Error communicating with LLM server: {e}")
+    # Attempt to get more details if it's an HTTP error with a response body
+    if isinstance(e, httpx.HTTPStatusError):
+        try:
+            error_details = _json_loads(e.response.content)
+            return {"error": f"Failed to get response from LLM server: {e}", "details": error_details}
+        except ValueError:
+            return {"error": f"Failed to get response from LLM server: {e}", "response_text": e.response.text}
+    return {"error": f"Failed to get response from LLM server: {e}"}
+
+
+def _ensure_batch_worker():
+    global _batch_worker_task
+    if _batch_worker_task is None or _batch_worker_task.done():
+        _batch_worker_task = asyncio.create_task(_batch_worker())
+
+
+async def _batch_worker():
+    """Drain queued requests in small time windows and dispatch them as batches."""
+    loop = asyncio.get_running_loop()
+    while True:
+        batch = [await _batch_queue.get()]
+        deadline = loop.time() + _BATCH_WINDOW
+        while len(batch) < _MAX_BATCH_SIZE:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(_batch_queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+
+        # Only requests with identical sampling parameters can share a request
+        groups = {}
+        for item in batch:
+            groups.setdefault((item[1], item[2]), []).append(item)
+        for (max_tokens, temperature), items in groups.items():
+            task = asyncio.create_task(_send_batch(items, max_tokens, temperature))
+            _batch_tasks.add(task)
+            task.add_done_callback(_batch_tasks.discard)
+
+
+async def _send_batch(items, max_tokens, temperature):
+    """Send several pre-rendered prompts in one /v1/completions request and resolve their futures."""
+    prefix, suffix, stop = _TEMPLATE
+    payload = {
+        "prompt": [f"{prefix}{prompt}{suffix}" for prompt, _, _, _ in items],
+        "stop": stop,
+        "model": _MODEL,
+        "max_tokens": max_tokens,
+        "temperature": temperature
+    }
+
+    results = []
+    try:
+        response = await _CLIENT.post(
+            _URL,
+            content=_json_dumps(payload),
+            headers=_HEADERS
+        )
+        response.raise_for_status()
+        result = _json_loads(response.content)
+
+        # llama-server answers a prompt array with an array of completions (a single object for one
+        # prompt), each holding one choice tagged with the index of the prompt it was generated for
+        completions = result if isinstance(result, list) else [result]
+        results = [None] * len(items)
+        try:
+            for completion in completions:
+                choice = completion["choices"][0]
+                results[choice["index"]] = {"result": choice["text"]}
+        except (KeyError, IndexError, TypeError):
+            results = [None]
+        if None in results:
+            results = [_unexpected_response(result)] * len(items)
+
+    except httpx.HTTPError as e:
+        results = [_http_error(e)] * len(items)
+    except Exception as e:
+        print(f"An unexpected error occurred in client: {e}")
+        results = [{"error": f"An unexpected error occurred: {e}"}] * len(items)
+    finally:
+        # Always resolve every waiting job, even if this task is cancelled or error handling itself fails
+        for position, (_, _, _, future) in enumerate(items):
+            if not future.done():
+                if position < len(results):
+                    future.set_result(results[position])
+                else:
+                    future.set_result({"error": "Batch request to LLM server was interrupted."})
+
+
+async def send_completion_request(prompt, max_tokens=500, temperature=0.7):
     """
-    Send a chat completion request to the llama.cpp server
+    Send a completion request for a single user message to the llama.cpp server
 
     Args:
         prompt (str): The user prompt
@@ -15,53 +203,113 @@ def send_completion_request(prompt, max_tokens=500, temperature=0.7):
     Returns:
         dict: Response from the server or error information
     """
-    server_status = get_server_status()
-
-    if not server_status["is_ready"]:
+    if not _STATUS.is_ready:
         return {"error": "Llama.cpp server is not ready. Initialization failed."}
 
     if not prompt:
         return {"error": "No prompt provided."}
 
-    # Prepare request payload for the llama_cpp.server (OpenAI compatible chat completions)
-    payload = {
-        "messages": [{"role": "user", "content": prompt}],
-        "model": server_status["model_file"],
-        "max_tokens": max_tokens,
-        "temperature": temperature
-    }
+    try:
+        max_tokens, temperature = _coerce_params(max_tokens, temperature)
+    except ValueError as e:
+        return {"error": str(e)}
 
-    headers = {"Content-Type": "application/json"}
-    if server_status["api_token"]:
-        headers["Authorization"] = f"Bearer {server_status['api_token']}"
+    # Pre-rendered prompts can share a multi-prompt /v1/completions request with other jobs
+    if _TEMPLATE:
+        _ensure_batch_worker()
+        future = asyncio.get_running_loop().create_future()
+        await _batch_queue.put((prompt, max_tokens, temperature, future))
+        return await future
+
+    payload = _build_payload(prompt, max_tokens, temperature)
 
     try:
-        response = requests.post(
-            f"{server_status['server_url']}/v1/chat/completions",
-            json=payload,
-            headers=headers,
-            timeout=120
+        response = await _CLIENT.post(
+            _URL,
+            content=_json_dumps(payload),
+            headers=_HEADERS
         )
         response.raise_for_status()
-        result = response.json()
+        result = _json_loads(response.content)
 
         # Extract the generated content from the OpenAI-compatible response
         if result and result.get("choices"):
             generated_text = result["choices"][0]["message"]["content"]
             return {"result": generated_text}
         else:
-            return {"error": f"Unexpected response format from LLM server: {json.dumps(result)}"}
+            return _unexpected_response(result)
 
-    except requests.exceptions.RequestException as e:
-        print(f"Error communicating with LLM server: {e}")
-        # Attempt to get more details if it's an HTTP error with a response body
-        if hasattr(e, 'response') and e.response is not None:
-            try:
-                error_details = e.response.json()
-                return {"error": f"Failed to get response from LLM server: {e}", "details": error_details}
-            except json.JSONDecodeError:
-                return {"error": f"Failed to get response from LLM server: {e}", "response_text": e.response.text}
-        return {"error": f"Failed to get response from LLM server: {e}"}
+    except httpx.HTTPError as e:
+        return _http_error(e)
+    except Exception as e:
+        print(f"An unexpected error occurred in client: {e}")
+        return {"error": f"An unexpected error occurred: {e}"}
+
+
+async def stream_completion_request(prompt, max_tokens=500, temperature=0.7):
+    """
+    Stream a completion for a single user message from the llama.cpp server
+
+    Args:
+        prompt (str): The user prompt
+        max_tokens (int): Maximum tokens to generate
+        temperature (float): Temperature for generation
+
+    Yields:
+        dict: Generated text deltas as {"result": ...}, or a final error information dict
+    """
+    if not _STATUS.is_ready:
+        yield {"error": "Llama.cpp server is not ready. Initialization failed."}
+        return
+
+    if not prompt:
+        yield {"error": "No prompt provided."}
+        return
+
+    try:
+        max_tokens, temperature = _coerce_params(max_tokens, temperature)
+    except ValueError as e:
+        yield {"error": str(e)}
+        return
+
+    payload = _build_payload(prompt, max_tokens, temperature, stream=True)
+
+    try:
+        async with _CLIENT.stream("POST", _URL, content=_json_dumps(payload), headers=_HEADERS) as response:
+            if response.is_error:
+                await response.aread()  # Load the error body for _http_error
+            response.raise_for_status()
+
+            # Server-sent events: one "data: {...}" line per chunk, terminated by "data: [DONE]"
+            done = False
+            async for line in response.aiter_lines():
+                # Failures after the 200 status (e.g. a prompt longer than the slot context) arrive as error events
+                if line.startswith("error: "):
+                    try:
+                        error_details = _json_loads(line[7:])
+                    except ValueError:
+                        error_details = line[7:]
+                    yield {"error": "LLM server reported an error while streaming.", "details": error_details}
+                    return
+                if not line.startswith("data: "):
+                    continue
+                data = line[6:]
+                if data == "[DONE]":
+                    done = True
+                    break
+                chunk = _json_loads(data)
+                if not chunk.get("choices"):
+                    continue
+                choice = chunk["choices"][0]
+                delta = choice.get("text") if _TEMPLATE else choice.get("delta", {}).get("content")
+                if delta:
+                    yield {"result": delta}
+
+            if not done:
+                yield {"error": "LLM server closed the stream before it was complete."}
+
+    except httpx.HTTPError as e:
+        yield _http_error(e)
     except Exception as e:
         print(f"An unexpected error occurred in client: {e}")
-        return {"error": f"An unexpected error occurred: {e}"}
\ No newline at end of file
+        yield {"error": f"An unexpected error occurred: {e}"}
@@ -1,9 +1,13 @@
+import importlib.util
 import os
+import shlex
+import shutil
+import socket
 import subprocess
-import json
 import time
-import requests
+import httpx
 import sys
+from types import MappingProxyType, SimpleNamespace
 
 # Global variables
 llama_server_process = None
@@ -11,37 +15,101 @@ is_server_ready = False
 server_port = os.environ.get("SERVER_PORT", "9095")
 server_host = "0.0.0.0"  # Fixed to 0.0.0.0 for RunPod compatibility
 server_url = f"http://localhost:{server_port}"  # Use localhost for internal requests
-hf_model_file_name = None # To store the model file name globally for handler
+hf_model_file_name = os.environ.get("HF_MODEL_FILE")  # Model file name, shared with the handler
 api_token = os.environ.get("API_TOKEN")  # Optional API token for authentication
-
-def _execute_command(command, cwd=None):
-    """Helper to execute shell commands and print output."""
-    print(f"Executing command: {command}")
+chat_format = os.environ.get("CHAT_FORMAT", "gemma")
+llama_server_bin = os.environ.get("LLAMA_SERVER_BIN", "llama-server")
+n_parallel = int(os.environ.get("N_PARALLEL", "4"))  # llama-server slots decoded together
+
+# Readiness probe targets, built once before polling starts
+_HEALTH_URL = f"{server_url}/health"
+_WARM_UP_URL = f"{server_url}/v1/chat/completions"
+_HEALTH_HEADERS = MappingProxyType({"Authorization": f"Bearer {api_token}"} if api_token else {})
+
+# Server status shared with the client, so reading it does not allocate on every request
+_STATUS = SimpleNamespace(
+    is_ready=False,
+    server_url=server_url,
+    model_file=hf_model_file_name,
+    api_token=api_token is not None
+)
+
+# CHAT_FORMAT names mapped to the equivalent llama-server built-in chat templates
+_LLAMA_SERVER_CHAT_TEMPLATES = {
+    "gemma": "gemma",
+    "chatml": "chatml",
+    "llama-3": "llama3",
+    "llama-2": "llama2",
+}
+
+def _execute_command(args, cwd=None, env=None):
+    """Helper to execute a command (argv list, no shell), streaming its output to the worker's logs."""
+    print(f"Executing command: {shlex.join(args)}", flush=True)
     try:
-        result = subprocess.run(command, shell=True, check=True, capture_output=True, text=True, cwd=cwd)
-        if result.stdout:
-            print(f"STDOUT:\n{result.stdout}")
-        if result.stderr:
-            print(f"STDERR:\n{result.stderr}")
-        return result
+        # Output goes straight to the inherited stdout/stderr instead of being buffered and decoded here
+        return subprocess.run(args, check=True, cwd=cwd, env=env)
     except subprocess.CalledProcessError as e:
         print(f"Command failed with error: {e}")
-        print(f"STDOUT:\n{e.stdout}")
-        print(f"STDERR:\n{e.stderr}")
         raise
     except Exception as e:
         print(f"An unexpected error occurred: {e}")
         raise
 
+def _is_model_present(hf_model_repo, hf_model_file, hf_token):
+    """Check whether the model file is already on disk with the size published on Hugging Face."""
+    model_path = f"models/{hf_model_file}"
+    if not os.path.isfile(model_path) or os.path.getsize(model_path) == 0:
+        return False
+
+    # A single HEAD request for the remote size; trust the local file if it cannot be fetched
+    try:
+        from huggingface_hub import get_hf_file_metadata, hf_hub_url
+        metadata = get_hf_file_metadata(hf_hub_url(hf_model_repo, hf_model_file), token=hf_token)
+    except Exception as e:
+        print(f"Could not fetch remote size for {model_path}, using the local file: {e}")
+        return True
+
+    if metadata.size is not None and metadata.size != os.path.getsize(model_path):
+        print(f"Local {model_path} size does not match the remote file, downloading it again.")
+        return False
+    return True
+
+def _is_port_open():
+    """Cheap TCP connect probe to see whether the server is accepting connections yet."""
+    try:
+        with socket.create_connection(("localhost", int(server_port)), timeout=0.5):
+            return True
+    except OSError:
+        return False
+
+def _warm_up_server(client, deadline):
+    """Run a 1-token completion so weights and KV cache are initialized before the first real request."""
+    payload = {
+        "messages": [{"role": "user", "content": "."}],
+        "model": hf_model_file_name,
+        "max_tokens": 1,
+        "temperature": 0
+    }
+    # Never wait past the overall readiness deadline
+    read_timeout = min(120, max(0.5, deadline - time.monotonic()))
+    response = client.post(_WARM_UP_URL, json=payload, headers=_HEALTH_HEADERS, timeout=httpx.Timeout(read_timeout, connect=0.5))
+    if response.status_code != 200:
+        print(f"Warm-up request failed with status {response.status_code}: {response.text[:2048]}")
+        return False
+    return True
+
 def initialize_runner():
-    global llama_server_process, is_server_ready, server_port, server_url, hf_model_file_name, api_token
+    global llama_server_process, is_server_ready
+
+    # Initialization is idempotent: never reinstall or spawn a second server on the same port
+    if is_server_ready or llama_server_process is not None:
+        print("Llama.cpp runner already initialized, skipping.")
+        return
 
     print("Initializing Llama.cpp runner...")
 
     hf_token = os.environ.get("HUGGING_FACE_TOKEN")
     hf_model_repo = os.environ.get("HF_MODEL_REPO")
-    hf_model_file_name = os.environ.get("HF_MODEL_FILE")
-    server_config_file = os.environ.get("SERVER_CONFIG_FILE", "server_config.json")
 
     if not hf_token:
         print("ERROR: HUGGING_FACE_TOKEN environment variable not set.")
@@ -56,17 +124,34 @@ def initialize_runner():
     # Ensure models directory exists
     os.makedirs("models", exist_ok=True)
 
-    # Installation steps
+    # Dependencies are installed at image build time, only verify they are present
+    if shutil.which(llama_server_bin) is None:
+        print(f"ERROR: {llama_server_bin} binary not found in the image.")
+        sys.exit(1)
+    if importlib.util.find_spec("huggingface_hub") is None:
+        print("ERROR: huggingface_hub is not installed in the image.")
+        sys.exit(1)
+
+    # Model download (the model is chosen through environment variables, so it happens at runtime)
     try:
-        _execute_command("pip install llama-cpp-python[server] --extra-index-url https://abetlen.github.io/llama-cpp-python/whl/cu124")
-        _execute_command("pip install -U 'huggingface_hub'")
-        _execute_command(f"hf auth login --token {hf_token}")
-        _execute_command(f"hf download {hf_model_repo} {hf_model_file_name} --local-dir models/")
+        if _is_model_present(hf_model_repo, hf_model_file_name, hf_token):
+            print(f"Model models/{hf_model_file_name} already present, skipping download.")
+        else:
+            # The token is handed to the download through HF_TOKEN, no separate login step needed
+            download_env = {**os.environ, "HF_TOKEN": hf_token}
+            # Parallel chunked downloads through the Rust hf_transfer backend (enabling it without the
+            # package installed makes huggingface_hub fail, so only do it when it is available)
+            if importlib.util.find_spec("hf_transfer") is not None:
+                download_env["HF_HUB_ENABLE_HF_TRANSFER"] = "1"
+            _execute_command(
+                ["hf", "download", hf_model_repo, hf_model_file_name, "--local-dir", "models/"],
+                env=download_env
+            )
     except Exception as e:
-        print(f"Failed during installation or model download: {e}")
+        print(f"Failed during model download: {e}")
         sys.exit(1)
 
-    # Model parameters for server_config.json
+    # Model parameters for llama-server
     n_gpu_layers = int(os.environ.get("N_GPU_LAYERS", "-1"))
     n_ctx = int(os.environ.get("N_CTX", "40000"))
     n_batch = int(os.environ.get("N_BATCH", "512"))
@@ -74,71 +159,60 @@ def initialize_runner():
     offload_kqv = os.environ.get("OFFLOAD_KQV", "true").lower() == "true"
     use_mlock = os.environ.get("USE_MLOCK", "true").lower() == "true"
     rope_freq_scale = float(os.environ.get("ROPE_FREQ_SCALE", "4.0"))
-    chat_format = os.environ.get("CHAT_FORMAT", "gemma")
-
-    # Generate server_config.json
-    config_content = {
-        "host": server_host,
-        "port": int(server_port),
-        "models": [
-            {
-                "model": f"models/{hf_model_file_name}",
-                "n_gpu_layers": n_gpu_layers,
-                "n_ctx": n_ctx,
-                "n_batch": n_batch,
-                "n_threads": n_threads,
-                "offload_kqv": offload_kqv,
-                "use_mlock": use_mlock,
-                "rope_freq_scale": rope_freq_scale,
-                "chat_format": chat_format
-            }
-        ]
-    }
-
-    # Add API key if provided
-    if api_token:
-        config_content["api_key"] = api_token
-
-    try:
-        with open(server_config_file, "w") as f:
-            json.dump(config_content, f, indent=2)
-        print(f"Generated {server_config_file} with content:\n{json.dumps(config_content, indent=2)}")
-    except IOError as e:
-        print(f"ERROR: Failed to write server_config.json: {e}")
-        sys.exit(1)
 
-    # Start the llama_cpp.server in the background
+    # llama-server splits N_CTX between the parallel slots, so each request gets N_CTX / N_PARALLEL tokens
+    cmd = [
+        llama_server_bin, "-m", f"models/{hf_model_file_name}", "--host", server_host, "--port", str(server_port),
+        "-ngl", str(n_gpu_layers), "-c", str(n_ctx), "-b", str(n_batch), "-t", str(n_threads),
+        "--parallel", str(n_parallel), "--cont-batching", "--rope-freq-scale", str(rope_freq_scale)
+    ]
+    if not offload_kqv:
+        cmd.append("--no-kv-offload")
+    if use_mlock:
+        cmd.append("--mlock")
+    # Formats without a llama-server built-in fall back to the template embedded in the GGUF
+    if chat_format in _LLAMA_SERVER_CHAT_TEMPLATES:
+        cmd += ["--chat-template", _LLAMA_SERVER_CHAT_TEMPLATES[chat_format]]
+
+    # Start llama-server in the background (the API key goes through the environment, not argv,
+    # so it is not readable from /proc/<pid>/cmdline)
     try:
-        cmd = f"python3 -m llama_cpp.server --config_file {server_config_file}"
-        print(f"Starting llama_cpp.server in background: {cmd}")
-        llama_server_process = subprocess.Popen(cmd, shell=True, preexec_fn=os.setsid)
-        print(f"llama_cpp.server process started with PID: {llama_server_process.pid}")
+        print(f"Starting llama-server in background: {shlex.join(cmd)}")
+        server_env = {**os.environ, "LLAMA_API_KEY": api_token} if api_token else None
+        llama_server_process = subprocess.Popen(cmd, start_new_session=True, env=server_env)
+        print(f"llama-server process started with PID: {llama_server_process.pid}")
     except Exception as e:
-        print(f"ERROR: Failed to start llama_cpp.server: {e}")
+        print(f"ERROR: Failed to start llama-server: {e}")
         sys.exit(1)
 
-    # Wait for the server to become ready (10 minutes max)
-    print(f"Waiting for llama_cpp.server to become ready at {server_url}...")
-    for i in range(600):  # Try for up to 10 minutes (600 seconds)
-        try:
-            # Check the /health endpoint
-            headers = {}
-            if api_token:
-                headers["Authorization"] = f"Bearer {api_token}"
-
-            response = requests.get(f"{server_url}/health", timeout=5, headers=headers)
-            if response.status_code == 200:
-                print("Llama.cpp server is ready!")
-                is_server_ready = True
-                break
-        except requests.exceptions.ConnectionError:
-            pass # Server not up yet, ignore
-        except Exception as e:
-            print(f"Health check failed with unexpected error: {e}")
-
-        if i % 10 == 0:  # Print status every 10 seconds
-            print(f"Server not ready yet, retrying... ({i+1}/600) - {(i+1)/60:.1f} minutes elapsed")
-        time.sleep(1)
+    # Wait for the server to become ready (10 minutes max), polling quickly at first and backing off
+    print(f"Waiting for llama-server to become ready at {server_url}...")
+    start = time.monotonic()
+    deadline = start + 600
+    next_status_report = start + 10
+    delay = 0.05
+    with httpx.Client(transport=httpx.HTTPTransport(retries=0)) as client:
+        while time.monotonic() < deadline:
+            try:
+                # Tier 1: TCP probe, tier 2: /health endpoint, tier 3: minimal generation
+                if _is_port_open():
+                    response = client.get(_HEALTH_URL, timeout=httpx.Timeout(2, connect=0.5), headers=_HEALTH_HEADERS)
+                    if response.status_code == 200 and _warm_up_server(client, deadline):
+                        print("Llama.cpp server is ready!")
+                        is_server_ready = True
+                        _STATUS.is_ready = True
+                        break
+            except (httpx.ConnectError, httpx.TimeoutException):
+                pass # Server not up yet, ignore
+            except Exception as e:
+                print(f"Health check failed with unexpected error: {e}")
+
+            now = time.monotonic()
+            if now >= next_status_report:  # Print status every 10 seconds
+                print(f"Server not ready yet, retrying... - {(now - start)/60:.1f} minutes elapsed")
+                next_status_report = now + 10
+            time.sleep(delay)
+            delay = min(delay * 1.5, 2.0)
 
     if not is_server_ready:
         print("ERROR: Llama.cpp server did not become ready in 10 minutes.")
@@ -147,10 +221,5 @@ def initialize_runner():
         sys.exit(1)
 
 def get_server_status():
-    """Return current server status and configuration"""
-    return {
-        "is_ready": is_server_ready,
-        "server_url": server_url,
-        "model_file": hf_model_file_name,
-        "api_token": api_token is not None
-    }
\ No newline at end of file
+    """Return current server status and configuration (a shared object, updated in place)"""
+    return _STATUS
\ No newline at end of file
@@ -1,19 +1,29 @@
+import os
 import runpod
 from llama_initializer import initialize_runner
-from llama_client import send_completion_request
+from llama_client import send_completion_request, stream_completion_request
+
+try:
+    import uvloop
+    uvloop.install()  # Use the libuv event loop for the async handler
+except ImportError:  # Fall back to the default asyncio event loop when uvloop is unavailable
+    pass
 
 # Initialize the runner globally when the script is loaded
 initialize_runner()
 
-def handler(event):
+# Number of jobs this worker keeps in flight so the server can batch them together
+max_concurrency = int(os.environ.get("MAX_CONCURRENCY", "8"))
+
+async def handler(event):
     """
     This function processes incoming requests to your Serverless endpoint.
 
     Args:
         event (dict): Contains the input data and request metadata
 
-    Returns:
-        dict: The result to be returned to the client
+    Yields:
+        dict: The whole result, or generated text chunks when 'stream' is enabled
     """
     print("Processing request...")
 
@@ -22,16 +32,29 @@ def handler(event):
     prompt = input_data.get('prompt')
 
     if not prompt:
-        return {"error": "No 'prompt' found in job input."}
+        yield {"error": "No 'prompt' found in job input."}
+        return
 
     # Extract optional parameters
     max_tokens = input_data.get('max_tokens', 500)
     temperature = input_data.get('temperature', 0.7)
+    stream = input_data.get('stream', False)
+
+    # Send request to llama.cpp server, forwarding tokens as they are generated
+    if stream:
+        async for chunk in stream_completion_request(prompt, max_tokens, temperature):
+            yield chunk
+    else:
+        yield await send_completion_request(prompt, max_tokens, temperature)
 
-    # Send request to llama.cpp server
-    result = send_completion_request(prompt, max_tokens, temperature)
 
-    return result
+def concurrency_modifier(current_concurrency):
+    """Allow up to MAX_CONCURRENCY jobs to run on this worker at the same time."""
+    return max_concurrency
 
 
-runpod.serverless.start({'handler': handler})
\ No newline at end of file
+runpod.serverless.start({
+    'handler': handler,
+    'concurrency_modifier': concurrency_modifier,
+    'return_aggregate_stream': True
+})
\ No newline at end of file